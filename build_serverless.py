@@ -10,28 +10,50 @@
 
 # TODO Output diagnostics about external references in scripts
 
-from __future__ import print_function
+import argparse
 import collections
 import errno
 import gzip
 import json
+import multiprocessing
 import os
 import shutil
 import subprocess
 import sys
 import hashlib
+import tempfile
+import zipfile
+from multiprocessing.pool import ThreadPool
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 if 'HIFI_OVEN' not in os.environ:
     print("ERROR: Environment variable `HIFI_OVEN` is not specified.")
     print("""
           The hifi `oven` is included with client+server installs of High Fidelity, and will be located in
-          the root directory that you installed High Fidelity in. Example: C:\Program Files\High Fidelity\oven.exe
+          the root directory that you installed High Fidelity in. Example: C:\\Program Files\\High Fidelity\\oven.exe
           """)
     sys.exit(1)
 
 oven_path = os.environ['HIFI_OVEN']
 verbose_logging = False
 
+# ioctl from linux/fs.h that makes a file share the data of another file (a reflink), on
+# filesystems that support it, such as btrfs and XFS.
+FICLONE = 0x40049409
+reflinks_supported = fcntl is not None and sys.platform.startswith('linux')
+
+# Progress is only logged every this many assets, to keep terminal writes out of the asset loops
+PROGRESS_INTERVAL = 64
+
 def log(prefix, *args):
     print(prefix, *args)
     sys.stdout.flush()
@@ -46,6 +68,20 @@ def info(*args):
 def error(*args):
     log('[ERROR]', *args)
 
+def progress(label, count, total):
+    """
+    Log `count` out of `total` items done, overwriting the previous progress line. Only every
+    PROGRESS_INTERVAL-th count and the final one are logged, and nothing is logged with verbose
+    logging, where each item is already logged on its own.
+    """
+    if verbose_logging:
+        return
+    if count == total:
+        print('\r[INFO] {} {}/{}'.format(label, count, total))
+    elif count % PROGRESS_INTERVAL == 0:
+        print('\r[INFO] {} {}/{}'.format(label, count, total), end='')
+        sys.stdout.flush()
+
 
 def makedirs(path):
     """
@@ -61,6 +97,43 @@ def makedirs(path):
             return False
         raise
 
+def load_json(filepath):
+    """Load the JSON file at `filepath`, using orjson if it is available."""
+    if orjson is not None:
+        with open(filepath, 'rb') as f:
+            return orjson.loads(f.read())
+    with open(filepath, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+def write_json(filepath, obj):
+    """
+    Write `obj` to `filepath` as UTF-8 JSON indented by 2 spaces, using orjson if it is
+    available.
+    """
+    if orjson is not None:
+        data = orjson.dumps(obj, option=orjson.OPT_INDENT_2)
+    else:
+        data = json.dumps(obj, indent=2, separators=(',', ': '), ensure_ascii=False).encode('utf-8')
+    with open(filepath, 'wb') as f:
+        f.write(data)
+
+def iter_files(root):
+    """
+    Yield a (relative directory path, filename, absolute path) tuple for every file under
+    `root`. The relative directory path uses '/' separators, and is '' for files directly
+    inside `root`. Like os.walk, symlinks to directories are not followed.
+    """
+    stack = [('', root)]
+    while stack:
+        rel_dirpath, dirpath = stack.pop()
+        with os.scandir(dirpath) as it:
+            for entry in it:
+                if entry.is_dir():
+                    if not entry.is_symlink():
+                        stack.append((rel_dirpath + '/' + entry.name if rel_dirpath else entry.name, entry.path))
+                else:
+                    yield rel_dirpath, entry.name, entry.path
+
 def get_extension(path):
     """Return the extension after the last '.' in a path. """
     idx = path.rfind('.')
@@ -82,47 +155,275 @@ def pathresolve(root, path):
 class BakeException(Exception):
     pass
 
-def bake_asset(abs_asset_path, baked_asset_output_dir, texture_type=None):
-    makedirs(baked_asset_output_dir)
+BAKE_CACHE_MANIFEST_FILENAME = 'manifest.json'
+
+# Written into each baked asset directory to record the oven bake type its files were baked as.
+# It is left out of the tutorial archive.
+BAKE_STAMP_FILENAME = '.bake_type'
+
+def get_bake_cache_key(abs_asset_path, filetype):
+    """
+    Return the bake cache key for baking `abs_asset_path` as `filetype`. The key covers the
+    content and name of the file, and the oven build, so that a new oven invalidates the cache.
+    """
+    sha1 = hashlib.sha1()
+    sha1.update('{}\0{}\0{}\0'.format(os.path.getmtime(oven_path), filetype,
+                                      os.path.basename(abs_asset_path)).encode('utf-8'))
+    with open(abs_asset_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+def is_up_to_date(output_path, input_paths):
+    """
+    Return True if `output_path` exists and was modified no earlier than any of `input_paths`.
+    """
+    try:
+        output_mtime = os.path.getmtime(output_path)
+    except OSError:
+        return False
+    return all(os.path.getmtime(path) <= output_mtime for path in input_paths)
+
+def read_bake_stamp(baked_asset_output_dir):
+    """
+    Return the oven bake type recorded in the baked asset directory `baked_asset_output_dir`, or
+    None if none is recorded.
+    """
+    try:
+        with open(os.path.join(baked_asset_output_dir, BAKE_STAMP_FILENAME)) as f:
+            return f.read()
+    except OSError:
+        return None
+
+def copy_file(src, dst):
+    """
+    Copy the file `src` to `dst`, as a reflink if the filesystem supports it, so that no data
+    needs to be copied. An existing `dst` is replaced by a new file rather than overwritten, so
+    that other links to it are left untouched.
+    """
+    global reflinks_supported
+    try:
+        os.remove(dst)
+    except FileNotFoundError:
+        pass
+    if reflinks_supported:
+        with open(src, 'rb') as fsrc:
+            with open(dst, 'wb') as fdst:
+                try:
+                    fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+                    return
+                except OSError as e:
+                    # Don't keep trying on filesystems that can't do it
+                    if e.errno in (errno.EOPNOTSUPP, errno.ENOTTY, errno.EINVAL, errno.ENOSYS):
+                        reflinks_supported = False
+    shutil.copyfile(src, dst)
+
+def link_or_copy(src, dst):
+    try:
+        os.link(src, dst)
+    except OSError:
+        copy_file(src, dst)
+
+def restore_from_bake_cache(cache_entry_dir, baked_asset_output_dir):
+    """
+    Copy the files in the bake cache entry `cache_entry_dir` into `baked_asset_output_dir`.
+    Return False if there is no such entry, or if it is damaged, in which case it is removed and
+    `baked_asset_output_dir` is left empty.
+    """
+    try:
+        f = open(os.path.join(cache_entry_dir, BAKE_CACHE_MANIFEST_FILENAME))
+    except OSError:
+        return False
+
+    try:
+        with f:
+            files = json.load(f)['files']
+        for rel_path in files:
+            abs_path = os.path.join(baked_asset_output_dir, rel_path)
+            makedirs(os.path.dirname(abs_path))
+            copy_file(os.path.join(cache_entry_dir, rel_path), abs_path)
+    except (OSError, ValueError, KeyError, TypeError):
+        # An unreadable manifest or a missing file means the entry can't be trusted, so it is
+        # dropped along with anything already copied from it, and the asset is baked again.
+        debug('  Removing damaged bake cache entry: ' + cache_entry_dir)
+        shutil.rmtree(cache_entry_dir, ignore_errors=True)
+        for entry in os.scandir(baked_asset_output_dir):
+            if entry.is_dir(follow_symlinks=False):
+                shutil.rmtree(entry.path)
+            else:
+                os.remove(entry.path)
+        return False
+    return True
+
+def link_or_copy_tree(src_dir, dst_dir):
+    """
+    Link, or copy, every file under `src_dir` to the same relative location under `dst_dir`.
+    Returns the relative paths of the files, with '/' separators.
+    """
+    files = []
+    for dirpath, _dirs, filenames in os.walk(src_dir):
+        rel_dirpath = os.path.relpath(dirpath, src_dir)
+        for filename in filenames:
+            rel_path = os.path.normpath(os.path.join(rel_dirpath, filename))
+            makedirs(os.path.join(dst_dir, rel_dirpath))
+            link_or_copy(os.path.join(dirpath, filename), os.path.join(dst_dir, rel_path))
+            files.append(rel_path.replace('\\', '/'))
+    return files
+
+def make_temp_dir(dirpath):
+    """
+    Create and return a new temporary directory next to `dirpath`, to be moved into its place
+    with `replace_dir`.
+    """
+    parent_dir = os.path.dirname(dirpath)
+    makedirs(parent_dir)
+    return tempfile.mkdtemp(dir=parent_dir, prefix='.tmp-')
+
+def replace_dir(temp_dir, dirpath):
+    """
+    Move the directory `temp_dir` to `dirpath`, replacing whatever was there before.
+    """
+    if os.path.isdir(dirpath):
+        shutil.rmtree(dirpath)
+    os.rename(temp_dir, dirpath)
+
+def remove_stale_outputs(dirpath, output_paths):
+    """
+    Remove every file and directory under `dirpath` other than `output_paths`, the files and
+    directories written by this build, and the directories that contain them. Anything under a
+    directory in `output_paths` is kept.
+    """
+    output_parent_dirs = set()
+    for path in output_paths:
+        path = os.path.dirname(path)
+        while path.startswith(dirpath + os.sep) and path not in output_parent_dirs:
+            output_parent_dirs.add(path)
+            path = os.path.dirname(path)
+
+    for abs_dirpath, dirnames, filenames in os.walk(dirpath):
+        for name in list(dirnames):
+            path = os.path.join(abs_dirpath, name)
+            if path in output_parent_dirs:
+                continue
+            dirnames.remove(name)
+            if path not in output_paths:
+                debug("  Removing stale output:", path)
+                shutil.rmtree(path)
+        for name in filenames:
+            path = os.path.join(abs_dirpath, name)
+            if path not in output_paths:
+                debug("  Removing stale output:", path)
+                os.remove(path)
+
+def add_to_bake_cache(cache_entry_dir, baked_asset_output_dir):
+    """
+    Save the files in `baked_asset_output_dir` as the bake cache entry `cache_entry_dir`.
+    """
+    bake_cache_dir = os.path.dirname(cache_entry_dir)
+    makedirs(bake_cache_dir)
+
+    # The entry is assembled next to its final location and renamed into place, so a
+    # half-written entry is never picked up.
+    temp_dir = tempfile.mkdtemp(dir=bake_cache_dir)
+    files = link_or_copy_tree(baked_asset_output_dir, temp_dir)
+    with open(os.path.join(temp_dir, BAKE_CACHE_MANIFEST_FILENAME), 'w') as f:
+        json.dump({'files': files}, f)
+
+    try:
+        os.rename(temp_dir, cache_entry_dir)
+    except OSError:
+        # Another bake of the same content got there first
+        shutil.rmtree(temp_dir)
+
+def get_bake_parameters(abs_asset_path, texture_type=None):
+    """
+    Return an (oven input path, oven bake type, baked output filename, input paths) tuple for baking
+    the asset at `abs_asset_path`, or None if it can't be baked. The input paths are all the files
+    that the baked output depends on.
+    """
     ext = get_extension(abs_asset_path).lower()
-    filetype = ''
-    abs_baked_path = ''
+    input_paths = [abs_asset_path]
 
     directory, filename = os.path.split(abs_asset_path)
     basename = remove_extension_from_filename(filename)
-    baked_output_filename = ''
-
-    extra_bake_args = []
 
     if ext == 'fbx':
-        filetype = 'fbx'
-        baked_output_filename = basename + '.baked.fbx'
+        return abs_asset_path, 'fbx', basename + '.baked.fbx', input_paths
     elif ext in ('png', 'jpg'):
-        filetype = texture_type
-        baked_output_filename = basename + '.texmeta.json'
+        return abs_asset_path, texture_type, basename + '.texmeta.json', input_paths
     elif abs_asset_path.endswith('.texmeta.json'):
         with open(abs_asset_path) as f:
             original_path = json.load(f)['original']
-            abs_asset_path = pathresolve(os.path.dirname(abs_asset_path), original_path)
-        baked_output_filename = basename + '.texmeta.json'
-        filetype = 'albedo'
+        oven_input_path = pathresolve(directory, original_path)
+        input_paths.append(oven_input_path)
+        return oven_input_path, 'albedo', basename + '.texmeta.json', input_paths
     else:
         error("Unkown bake extension:", ext)
         return None
 
-    with open(os.devnull, 'w') as devnull:
-        if verbose_logging:
-            devnull = None
-        args = [oven_path,
-                '-i', abs_asset_path,
-                '-o', baked_asset_output_dir,
-                '-t', filetype] + extra_bake_args
-        debug('  Running oven: ' + ' '.join(args))
-        returncode = subprocess.call(args, stdout=devnull, stderr=devnull)
-        if returncode != 0:
-            raise BakeException()
+def bake_asset(abs_asset_path, baked_asset_output_dir, texture_type=None, single_threaded=False,
+               bake_cache_dir=None, skip_up_to_date=False, bake_parameters=None):
+    """
+    Bake the asset at `abs_asset_path` into `baked_asset_output_dir` and return the path of the
+    baked output file. If `single_threaded` is True, OMP_NUM_THREADS is set to 1 in oven's
+    environment, for when several bakes are already running side by side. If `bake_cache_dir` is
+    given, the output is taken from the bake cache there when possible, and saved to it otherwise.
+    If `skip_up_to_date` is True, the asset isn't baked again if it was baked as the same type and
+    its baked output file is newer than its inputs. `bake_parameters` are the asset's parameters from `get_bake_parameters`, if they
+    are already known.
+    """
+    if bake_parameters is None:
+        bake_parameters = get_bake_parameters(abs_asset_path, texture_type)
+        if bake_parameters is None:
+            return None
+    abs_asset_path, filetype, baked_output_filename, input_paths = bake_parameters
+
+    abs_baked_path = os.path.join(baked_asset_output_dir, baked_output_filename)
+    # The same file baked as another type gives different output, so the type it was baked as
+    # has to match as well
+    if (skip_up_to_date and read_bake_stamp(baked_asset_output_dir) == filetype
+            and is_up_to_date(abs_baked_path, input_paths)):
+        debug('  Already baked: ' + abs_baked_path)
+        return abs_baked_path
+
+    # The output is assembled in a new directory and then moved into place, so that nothing is
+    # ever written into files from an earlier build, which may be linked to bake cache entries.
+    temp_dir = make_temp_dir(baked_asset_output_dir)
+    try:
+        cache_entry_dir = None
+        if bake_cache_dir is not None:
+            cache_entry_dir = os.path.join(bake_cache_dir, get_bake_cache_key(abs_asset_path, filetype))
+
+        if cache_entry_dir is not None and restore_from_bake_cache(cache_entry_dir, temp_dir):
+            debug('  Using cached bake: ' + cache_entry_dir)
+        else:
+            with open(os.devnull, 'w') as devnull:
+                if verbose_logging:
+                    devnull = None
+                args = [oven_path,
+                        '-i', abs_asset_path,
+                        '-o', temp_dir,
+                        '-t', filetype]
+                env = None
+                if single_threaded:
+                    env = dict(os.environ, OMP_NUM_THREADS='1')
+                if verbose_logging:
+                    debug('  Running oven: ' + ' '.join(args))
+                returncode = subprocess.call(args, stdout=devnull, stderr=devnull, env=env)
+                if returncode != 0:
+                    raise BakeException()
+
+            if cache_entry_dir is not None:
+                add_to_bake_cache(cache_entry_dir, temp_dir)
+
+        with open(os.path.join(temp_dir, BAKE_STAMP_FILENAME), 'w') as f:
+            f.write(filetype)
+        replace_dir(temp_dir, baked_asset_output_dir)
+    except:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+        raise
 
-    return os.path.join(baked_asset_output_dir, baked_output_filename)
+    return abs_baked_path
 
 Asset = collections.namedtuple('Asset', [
     'filename',       # Original asset filename. Baked assets might have a different output filename
@@ -140,27 +441,73 @@ def canonicalize_url(url):
         url = url[:idx]
     return url
 
-def get_textures_requiring_baking_from_entity_data(entities):
+def parse_entity_textures(entities):
     """
-    Go through entities and pull out the referenced URLs that need to be baked, and the usage type
-    that they need to be baked for. Returns the dictionary of values.
+    Parse the JSON `textures` property of every entity. Returns a list with the parsed textures of
+    each entity, in the same order as the entities, with None for entities that have no `textures`
+    property or whose `textures` property is a plain URL rather than JSON.
     """
-    urls = {}
+    entity_textures = []
+    for entity in entities['Entities']:
+        textures = None
+        if 'textures' in entity:
+            try:
+                if orjson is not None:
+                    textures = orjson.loads(entity['textures'])
+                else:
+                    textures = json.loads(entity['textures'])
+            except ValueError:
+                pass
+        entity_textures.append(textures)
+    return entity_textures
+
+# Entity properties that hold a URL, besides those with 'URL' in their name
+URL_PROPERTIES = frozenset(('script', 'serverScripts'))
+# Entity properties that hold an object of URLs of textures to bake as `cube`
+CUBE_TEXTURE_PROPERTIES = frozenset(('ambientLight', 'skybox'))
+
+def get_url_references_from_entity_data(entities, entity_textures):
+    """
+    Go through entities and pull out every property value that holds a URL. `entity_textures` are
+    the entities' parsed textures, as returned by `parse_entity_textures`. Returns a list of
+    (url, container, key, bake type) tuples, where `container[key]` holds the URL and the bake type
+    is the usage type that the URL needs to be baked for, or None if it doesn't need baking.
+    """
+    # Entities share a small set of property names, so which of them hold URLs is worked out once
+    prop_names = set()
     for entity in entities['Entities']:
-        for prop, value in entity.iteritems():
-            if prop in ('ambientLight', 'skybox'):
-                for url in value.itervalues():
-                    urls[canonicalize_url(url)] = 'cube'
+        prop_names.update(entity)
+    url_props = frozenset(prop for prop in prop_names if 'URL' in prop) | URL_PROPERTIES
+
+    url_refs = []
+    for entity, textures in zip(entities['Entities'], entity_textures):
+        for prop, value in entity.items():
+            if prop in url_props:
+                url_refs.append((value, entity, prop, None))
+            elif prop in CUBE_TEXTURE_PROPERTIES:
+                for key, url in value.items():
+                    url_refs.append((url, value, key, 'cube'))
             elif prop == 'textures':
-                try:
-                    textures = json.loads(value)
-                    for url in textures.itervalues():
-                        urls[canonicalize_url(url)] = 'albedo'
-                except ValueError:
-                    urls[canonicalize_url(value)] = 'albedo'
+                if textures is not None:
+                    for key, url in textures.items():
+                        url_refs.append((url, textures, key, 'albedo'))
+                else:
+                    url_refs.append((value, entity, prop, 'albedo'))
+    return url_refs
+
+def get_textures_requiring_baking_from_entity_data(url_refs):
+    """
+    Go through the URL references returned by `get_url_references_from_entity_data` and pull out
+    the referenced URLs that need to be baked, and the usage type that they need to be baked for.
+    Returns the dictionary of values.
+    """
+    urls = {}
+    for url, _container, _key, bake_type in url_refs:
+        if bake_type is not None:
+            urls[canonicalize_url(url)] = bake_type
     return urls
 
-def build_serverless_tutorial_content(input_dir, output_dir):
+def build_serverless_tutorial_content(input_dir, output_dir, jobs=None, bake_cache_dir=None, force=False):
     """
     Process the input directory domain content and generates a baked, serverless domain.
 
@@ -178,6 +525,14 @@ def build_serverless_tutorial_content(input_dir, output_dir):
       * Textures referenced in the `textures` property of an entity will be baked as `albedo`.
       * Textures referenced in *.texmeta.json files will be baked as `albedo`.
 
+    Up to `jobs` assets are baked at the same time, defaulting to the number of CPUs. If
+    `bake_cache_dir` is given, assets that were baked before are taken from the cache there
+    instead of being baked again.
+
+    Assets whose output in `output_dir` is newer than the asset itself, from an earlier build, are
+    neither baked nor copied again, unless `force` is True. Anything else under the baked and
+    unbaked output directories, left over from earlier builds, is removed.
+
     """
     info("Building serverless tutorial content")
     info("  Input directory: " + input_dir)
@@ -185,112 +540,208 @@ def build_serverless_tutorial_content(input_dir, output_dir):
 
     assets_not_found = set()
 
+    # Made absolute once here, so that the paths built from it below don't need to be
+    output_dir = os.path.abspath(output_dir)
     input_assets_dir = os.path.join(input_dir, 'assets')
     input_models_filepath = os.path.join(input_dir, 'entities', 'models.json')
     input_paths_filepath = os.path.join(input_dir, 'paths.json')
     output_models_filepath = os.path.join(output_dir, 'tutorial.json')
 
     entities = None
-    with open(input_models_filepath, 'r') as models_file:
-        try:
-            entities = json.load(models_file)
-        except:
-            error("ERROR: Failed to load models file")
-            raise
+    try:
+        entities = load_json(input_models_filepath)
+    except:
+        error("ERROR: Failed to load models file")
+        raise
 
-    textures_requiring_baking = get_textures_requiring_baking_from_entity_data(entities)
+    # The `textures` property is JSON in a string. It is parsed once here, and serialized again
+    # once its URLs have been updated.
+    entity_textures = parse_entity_textures(entities)
+    # Every URL in the entities is found once, up front, so that updating them later doesn't
+    # need to go through every property of every entity again.
+    url_refs = get_url_references_from_entity_data(entities, entity_textures)
+    textures_requiring_baking = get_textures_requiring_baking_from_entity_data(url_refs)
 
     # This is used to translate ATP references in the input models file to their final serverless URL
     # Ex: atp:/models/someFile.fbx => file:///~/serverless/baked/models/someFile.fbx/someFile.baked.fbx
     # Ex: atp:/script.js => file:///~/serverless/unbaked/scripts/script.js
     atp_path_to_output_path = {}
 
-    # Collect list of all assets in the /src/assets dir.
-    # For each asset, store:
-    #   Filename                ("src/assets/models/pieces/bridge.fbx" would be "bridge.fbx")
-    #   Relative directory path ("src/assets/models/pieces/bridge.fbx" would be "models/pieces")
-    #   ATP Path                ("src/assets/models/pieces/bridge.fbx" would be "atp:/models/pieces/bridge.fbx")
-    #   Absolute file path      ("src/assets/models/pieces/bridge.fbx" would be be expanded to the
-    #                                                                  full absolute path on disk)
-    assets = []
-    for dirpath, _dirs, files in os.walk(input_assets_dir):
-        for filename in files:
-            asset_rel_dir = os.path.relpath(dirpath, input_assets_dir).replace('\\', '/')
-            if asset_rel_dir == '.':
-                asset_rel_dir = ''
-            else:
-                asset_rel_dir = asset_rel_dir
-
-            abs_asset_path = os.path.normpath(
-                    os.path.join(input_assets_dir, dirpath, filename))
-
-            atp_path = '/'.join((el for el in ('atp:', asset_rel_dir, filename) if el != ''))
-
-            assets.append(Asset(filename, asset_rel_dir, atp_path, abs_asset_path))
-
-
-    # Process all assets. Bakeable assets will be baked and moved to the output directory, and the
-    # rest will be copied over to the output directory.t
     BAKED_SUBDIRECTORY = 'baked'
     UNBAKED_SUBDIRECTORY = 'unbaked'
-    for asset in assets:
-        is_fbx = asset.filename.endswith('.fbx')
-        is_texmeta = asset.filename.endswith('.texmeta.json')
-        is_texture_requiring_baking = asset.atp_path in textures_requiring_baking
-        should_copy = True
-        if is_fbx or is_texture_requiring_baking or is_texmeta:
-            texture_type = None
-            if is_texture_requiring_baking:
-                texture_type = textures_requiring_baking[asset.atp_path]
-            info("Baking", '/' + joinpath(asset.rel_dirpath, asset.filename))
-            baked_asset_output_dir = os.path.abspath(os.path.join(output_dir, BAKED_SUBDIRECTORY, asset.rel_dirpath, asset.filename))
-            try:
-                output_abs_path = bake_asset(asset.input_abs_path, baked_asset_output_dir, texture_type)
+
+    # With several ovens running at once, any OpenMP threading inside them is limited to one
+    # thread each, so they don't start a thread per core in every process.
+    single_threaded = (jobs or multiprocessing.cpu_count()) > 1
+
+    def bake_job(asset, baked_asset_output_dir, texture_type, bake_parameters):
+        try:
+            return bake_asset(asset.input_abs_path, baked_asset_output_dir, texture_type, single_threaded,
+                              bake_cache_dir, not force, bake_parameters)
+        except BakeException:
+            return None
+
+    # Assets whose bake failed are always copied, because the file at their unbaked location may
+    # be a .texmeta.json written for an earlier, successful bake rather than a copy.
+    def copy_job(asset, bake_failed=False):
+        output_abs_path = os.path.join(output_dir, UNBAKED_SUBDIRECTORY, asset.rel_dirpath, asset.filename)
+        if not force and not bake_failed and is_up_to_date(output_abs_path, (asset.input_abs_path,)):
+            debug("  Already copied:", output_abs_path)
+            return output_abs_path
+        debug("  Copying", asset.input_abs_path, 'to', output_abs_path)
+        copy_file(asset.input_abs_path, output_abs_path)
+        return output_abs_path
+
+    # Unbaked output directories are created once each, rather than once per file
+    unbaked_rel_dirpaths = set()
+    def make_unbaked_dir(rel_dirpath):
+        if rel_dirpath not in unbaked_rel_dirpaths:
+            makedirs(os.path.join(output_dir, UNBAKED_SUBDIRECTORY, rel_dirpath))
+            unbaked_rel_dirpaths.add(rel_dirpath)
+
+    # Every bake runs in its own oven process, so a thread per job is enough to keep `jobs` ovens
+    # busy at once. Bakes and copies are handed to the pool as soon as the assets are found, so the
+    # walk, the copies and the bakes all overlap. Results are handled here, on the main thread, in
+    # the order the assets were found.
+    pool = ThreadPool(jobs)
+    try:
+        # Go through all assets in the /src/assets dir.
+        # For each asset, store:
+        #   Filename                ("src/assets/models/pieces/bridge.fbx" would be "bridge.fbx")
+        #   Relative directory path ("src/assets/models/pieces/bridge.fbx" would be "models/pieces")
+        #   ATP Path                ("src/assets/models/pieces/bridge.fbx" would be "atp:/models/pieces/bridge.fbx")
+        #   Absolute file path      ("src/assets/models/pieces/bridge.fbx" would be be expanded to the
+        #                                                                  full absolute path on disk)
+        # Bakeable assets will be baked and moved to the output directory, and the rest will be
+        # copied over to the output directory.
+        bakes = []
+        copies = []
+        # Every file or baked asset directory written under the output directory
+        output_paths = set()
+        # Reported once all the bakes are done, so they aren't written onto the progress line
+        failed_bakes = []
+        # oven has no way to bake several files in one run, so the most its startup cost can be
+        # cut is to run it once per distinct input. Assets that bake the same file the same way,
+        # such as a texture and a .texmeta.json that points at it, share a single bake.
+        first_bakes = {}
+        for asset_rel_dir, filename, abs_asset_path in iter_files(input_assets_dir):
+            if asset_rel_dir:
+                atp_path = 'atp:/' + asset_rel_dir + '/' + filename
+            else:
+                atp_path = 'atp:/' + filename
+            asset = Asset(filename, asset_rel_dir, atp_path, abs_asset_path)
+
+            is_fbx = filename.endswith('.fbx')
+            is_texmeta = filename.endswith('.texmeta.json')
+            is_texture_requiring_baking = atp_path in textures_requiring_baking
+            if is_fbx or is_texture_requiring_baking or is_texmeta:
+                texture_type = None
+                if is_texture_requiring_baking:
+                    texture_type = textures_requiring_baking[atp_path]
+                baked_asset_output_dir = os.path.join(output_dir, BAKED_SUBDIRECTORY, asset_rel_dir, filename)
+                bake_parameters = get_bake_parameters(abs_asset_path, texture_type)
+                if bake_parameters is None:
+                    failed_bakes.append(abs_asset_path)
+                    make_unbaked_dir(asset_rel_dir)
+                    copies.append((asset, pool.apply_async(copy_job, (asset, True))))
+                    continue
+
+                oven_input_path, filetype, baked_output_filename, _ = bake_parameters
+                first_bake = first_bakes.get((oven_input_path, filetype))
+                if first_bake is None:
+                    result = pool.apply_async(bake_job, (asset, baked_asset_output_dir, texture_type, bake_parameters))
+                    first_bakes[(oven_input_path, filetype)] = (baked_asset_output_dir, result)
+                    bakes.append((asset, result, None))
+                else:
+                    first_baked_asset_output_dir, result = first_bake
+                    bakes.append((asset, result,
+                                  (first_baked_asset_output_dir, baked_asset_output_dir, baked_output_filename)))
+            else:
+                make_unbaked_dir(asset_rel_dir)
+                copies.append((asset, pool.apply_async(copy_job, (asset,))))
+
+        for i, (asset, result, shared_bake) in enumerate(bakes, 1):
+            output_abs_path = result.get()
+            progress("Baked", i, len(bakes))
+            if output_abs_path is not None and shared_bake is not None:
+                first_baked_asset_output_dir, baked_asset_output_dir, baked_output_filename = shared_bake
+                debug("  Reusing bake from:", first_baked_asset_output_dir)
+                # Linked into a new directory that then replaces the old one, so that no file
+                # from an earlier build, which may be a link to these same files, is written into
+                temp_dir = make_temp_dir(baked_asset_output_dir)
+                try:
+                    link_or_copy_tree(first_baked_asset_output_dir, temp_dir)
+                    replace_dir(temp_dir, baked_asset_output_dir)
+                except:
+                    shutil.rmtree(temp_dir, ignore_errors=True)
+                    raise
+                output_abs_path = os.path.join(baked_asset_output_dir, baked_output_filename)
+            if output_abs_path is None:
+                # Copy the asset as-is instead
+                failed_bakes.append(asset.input_abs_path)
+                make_unbaked_dir(asset.rel_dirpath)
+                copies.append((asset, pool.apply_async(copy_job, (asset, True))))
+                continue
+            output_paths.add(os.path.dirname(output_abs_path))
+
+            system_local_path = joinpath('file:///~/serverless', BAKED_SUBDIRECTORY, asset.rel_dirpath, asset.filename,
+                                         os.path.basename(output_abs_path))
+            if verbose_logging:
+                debug("Baked", '/' + joinpath(asset.rel_dirpath, asset.filename))
                 debug("  Baked path is at:", output_abs_path)
-                system_local_path = 'file:///~/serverless/' + os.path.relpath(output_abs_path, output_dir).replace('\\', '/')
                 debug("  Baked: " + asset.atp_path + " => " + system_local_path)
-                atp_path_to_output_path[asset.atp_path] = system_local_path
-                if is_texmeta:
-                    # If a script wants to reference "../textures/sky.texmeta.json", we want
-                    # to make sure that file is still accessible in the output directory at the same
-                    # relative location. To make that happen, we create a .texmeta.json that references
-                    # the baked textures, and is at the same relative location to scripts in the
-                    # unbaked subdirectory.
-                    unbaked_texmeta_abs_dir = os.path.join(output_dir, UNBAKED_SUBDIRECTORY, asset.rel_dirpath)
-                    unbaked_texmeta_abs_path = os.path.join(unbaked_texmeta_abs_dir, asset.filename)
+            atp_path_to_output_path[asset.atp_path] = system_local_path
+            if asset.filename.endswith('.texmeta.json'):
+                # If a script wants to reference "../textures/sky.texmeta.json", we want
+                # to make sure that file is still accessible in the output directory at the same
+                # relative location. To make that happen, we create a .texmeta.json that references
+                # the baked textures, and is at the same relative location to scripts in the
+                # unbaked subdirectory.
+                unbaked_texmeta_abs_dir = os.path.join(output_dir, UNBAKED_SUBDIRECTORY, asset.rel_dirpath)
+                unbaked_texmeta_abs_path = os.path.join(unbaked_texmeta_abs_dir, asset.filename)
+                if verbose_logging:
                     debug("  Creating texmeta at original location for script use:", '/' + joinpath(asset.rel_dirpath, asset.filename))
-                    makedirs(unbaked_texmeta_abs_dir)
-                    with open(output_abs_path) as f:
-                        data = json.load(f)
-                        new_data = {}
-                        def baked_relpath_to_unbaked_relpath(path):
-                            abs_path = os.path.join(os.path.dirname(output_abs_path), path)
-                            return os.path.relpath(abs_path, unbaked_texmeta_abs_dir).replace('\\', '/')
-                        if data['original'] != '':
-                            new_data['original'] = baked_relpath_to_unbaked_relpath(data['original'])
-                        if data['uncompressed'] != '':
-                            new_data['uncompressed'] = baked_relpath_to_unbaked_relpath(data['uncompressed'])
-                        if data['compressed'] is not None:
-                            new_data['compressed'] = {}
-                            compressed = data['compressed']
-                            for compression_type in compressed:
-                                new_data['compressed'][compression_type] = baked_relpath_to_unbaked_relpath(compressed[compression_type])
-                        with open(unbaked_texmeta_abs_path, 'w') as fw:
-                            json.dump(new_data, fw)
-
-                should_copy = False
-            except BakeException:
-                error("Error while baking: " + asset.input_abs_path)
-
-        if should_copy:
-            output_abs_dir = os.path.join(output_dir, UNBAKED_SUBDIRECTORY, asset.rel_dirpath)
-            output_abs_path = os.path.join(output_abs_dir, asset.filename)
-            info("Copying", '/' + joinpath(asset.rel_dirpath, asset.filename))
-            debug("  Copying", asset.input_abs_path, 'to', output_abs_path)
-            makedirs(output_abs_dir)
-            shutil.copyfile(asset.input_abs_path, output_abs_path)
+                make_unbaked_dir(asset.rel_dirpath)
+                # The baked .texmeta.json is written by oven, and the files and compression
+                # formats it lists can't be worked out from the source .texmeta.json, so it has to
+                # be read back here.
+                with open(output_abs_path) as f:
+                    data = json.load(f)
+                    new_data = {}
+                    def baked_relpath_to_unbaked_relpath(path):
+                        abs_path = os.path.join(os.path.dirname(output_abs_path), path)
+                        return os.path.relpath(abs_path, unbaked_texmeta_abs_dir).replace('\\', '/')
+                    if data['original'] != '':
+                        new_data['original'] = baked_relpath_to_unbaked_relpath(data['original'])
+                    if data['uncompressed'] != '':
+                        new_data['uncompressed'] = baked_relpath_to_unbaked_relpath(data['uncompressed'])
+                    if data['compressed'] is not None:
+                        new_data['compressed'] = {}
+                        compressed = data['compressed']
+                        for compression_type in compressed:
+                            new_data['compressed'][compression_type] = baked_relpath_to_unbaked_relpath(compressed[compression_type])
+                    with open(unbaked_texmeta_abs_path, 'w') as fw:
+                        json.dump(new_data, fw)
+                output_paths.add(unbaked_texmeta_abs_path)
+
+        for abs_asset_path in failed_bakes:
+            error("Error while baking: " + abs_asset_path)
+
+        for i, (asset, result) in enumerate(copies, 1):
+            output_paths.add(result.get())
+            progress("Copied", i, len(copies))
+            if verbose_logging:
+                debug("Copied", '/' + joinpath(asset.rel_dirpath, asset.filename))
             system_local_path = joinpath('file:///~/serverless', UNBAKED_SUBDIRECTORY, asset.rel_dirpath, asset.filename)
             atp_path_to_output_path[asset.atp_path] = system_local_path
+    finally:
+        pool.close()
+        pool.join()
+
+    # Outputs of assets that were removed, or that are no longer baked or copied, would otherwise
+    # stay in the output directory and end up in the archive
+    for subdirectory in (BAKED_SUBDIRECTORY, UNBAKED_SUBDIRECTORY):
+        remove_stale_outputs(os.path.join(output_dir, subdirectory), output_paths)
 
     def to_system_local_url(url):
         clean_url = canonicalize_url(url)
@@ -306,28 +757,21 @@ def build_serverless_tutorial_content(input_dir, output_dir):
 
     # Update URLs
     debug("Found " + str(len(entities['Entities'])) + " entities")
-    for entity in entities['Entities']:
-        for prop, value in entity.iteritems():
-            if 'URL' in prop or prop in ('script', 'serverScripts'):
-                entity[prop] = to_system_local_url(value)
-            elif prop in ('ambientLight', 'skybox'):
-                for key in value:
-                    value[key] = to_system_local_url(value[key])
-            elif prop == 'textures':
-                try:
-                    textures = json.loads(value)
-                    for key in textures:
-                        textures[key] = to_system_local_url(textures[key])
-                    entity['textures'] = json.dumps(textures)
-                except ValueError:
-                    entity['textures'] = to_system_local_url(value)
-
-    with open(input_paths_filepath, 'r') as paths_file:
-        paths = json.load(paths_file)
-        entities['Paths'] = paths['Paths']
-
-    with open(output_models_filepath, 'w') as models_file:
-        json.dump(entities, models_file, indent=4)
+    # Many entities share the same URLs, so each distinct URL is only translated once
+    system_local_urls = {}
+    for url, container, key, _bake_type in url_refs:
+        system_local_url = system_local_urls.get(url)
+        if system_local_url is None:
+            system_local_url = system_local_urls[url] = to_system_local_url(url)
+        container[key] = system_local_url
+    for entity, textures in zip(entities['Entities'], entity_textures):
+        if textures is not None:
+            entity['textures'] = json.dumps(textures)
+
+    paths = load_json(input_paths_filepath)
+    entities['Paths'] = paths['Paths']
+
+    write_json(output_models_filepath, entities)
 
     if len(assets_not_found) > 0:
         info("Errors:")
@@ -337,16 +781,57 @@ def build_serverless_tutorial_content(input_dir, output_dir):
     else:
         info("Success: No errors building serverless tutorial")
 
+# Extensions of files that are already compressed, and gain nothing from being deflated again
+ARCHIVE_STORED_EXTENSIONS = frozenset(('png', 'jpg', 'jpeg', 'ogg', 'mp3', 'zip', 'gz'))
+
+class HashingWriter:
+    """
+    Write-only file wrapper that computes the MD5 hash of everything written through it. It can't
+    seek, so zipfile writes an archive to it strictly in order.
+    """
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.md5 = hashlib.md5()
+
+    def write(self, data):
+        self.md5.update(data)
+        return self.fileobj.write(data)
+
+    def flush(self):
+        self.fileobj.flush()
+
+def write_archive(archive_file, dirpath, archive_path=None):
+    """
+    Write the contents of `dirpath` to the zip archive `archive_file`, a path or a writable file
+    object. If the archive is itself inside `dirpath`, `archive_path` is its path, so that it is
+    left out.
+    """
+    # Deflate at the fastest level; the archive is only slightly bigger than at the default level
+    with zipfile.ZipFile(archive_file, 'w', zipfile.ZIP_DEFLATED, compresslevel=1) as archive:
+        for abs_dirpath, dirnames, filenames in os.walk(dirpath):
+            # Sorted, as shutil.make_archive does, so the member order doesn't depend on the
+            # filesystem the archive is built on
+            dirnames.sort()
+            rel_dirpath = os.path.relpath(abs_dirpath, dirpath)
+            for name in dirnames:
+                archive.write(os.path.join(abs_dirpath, name), os.path.normpath(os.path.join(rel_dirpath, name)))
+            for name in sorted(filenames):
+                abs_path = os.path.join(abs_dirpath, name)
+                if abs_path == archive_path or name == BAKE_STAMP_FILENAME:
+                    continue
+                compress_type = zipfile.ZIP_DEFLATED
+                if get_extension(name).lower() in ARCHIVE_STORED_EXTENSIONS:
+                    compress_type = zipfile.ZIP_STORED
+                archive.write(abs_path, os.path.normpath(os.path.join(rel_dirpath, name)), compress_type)
+
 def create_serverless_tutorial_archive(dirpath):
     info("Creating tutorial archive")
-    archive_path = shutil.make_archive('tutorial', 'zip', dirpath)
-    with open(archive_path, 'rb') as f:
-        md5 = hashlib.md5()
-        for chunk in iter(lambda: f.read(4096), b''):
-            md5.update(chunk)
-        archive_hash = md5.hexdigest()
-    shutil.move(archive_path, dirpath)
-    archive_path = os.path.join(dirpath, os.path.basename(archive_path))
+    archive_path = os.path.join(dirpath, 'tutorial.zip')
+    # zipfile can write to unseekable files, so the archive is hashed as it is written
+    with open(archive_path, 'wb') as f:
+        writer = HashingWriter(f)
+        write_archive(writer, dirpath, archive_path)
+        archive_hash = writer.md5.hexdigest()
 
     print('''
     The serverless tutorial archive has succesfully been created at: {filename}
@@ -364,19 +849,24 @@ def create_serverless_tutorial_archive(dirpath):
     '''.format(filename=archive_path, archive_md5=archive_hash))
 
 if __name__ == '__main__':
-    if len(sys.argv) < 2:
-        print("Usage: " + sys.argv[0] + " output_dir")
-        sys.exit(1)
+    parser = argparse.ArgumentParser(description='Generate a serverless content set from the `src` directory.')
+    parser.add_argument('output_dir')
+    parser.add_argument('--verbose', action='store_true')
+    parser.add_argument('-j', '--jobs', type=int, default=multiprocessing.cpu_count(),
+                        help='Number of assets to bake at the same time (default: number of CPUs)')
+    parser.add_argument('--bake-cache', metavar='DIR',
+                        help='Reuse assets baked by earlier runs from DIR, and save new bakes there')
+    parser.add_argument('--force', action='store_true',
+                        help='Bake and copy every asset again, even if the output directory already has an up to date version')
+    args = parser.parse_args()
 
     input_dir = os.path.abspath('src')
-    output_dir = os.path.abspath(sys.argv[1])
-    if '--verbose' in sys.argv:
-        verbose_logging = True
+    output_dir = os.path.abspath(args.output_dir)
+    verbose_logging = args.verbose
 
-    if os.path.exists(output_dir) and len(os.listdir(output_dir)) != 0:
-        print('Output directory ' + output_dir + ' exists and is not empty.')
-        print('Please delete the directory first, or choose a different output directory.')
-        sys.exit(1)
+    bake_cache_dir = None
+    if args.bake_cache is not None:
+        bake_cache_dir = os.path.abspath(args.bake_cache)
 
-    build_serverless_tutorial_content(input_dir, output_dir)
+    build_serverless_tutorial_content(input_dir, output_dir, max(1, args.jobs), bake_cache_dir, args.force)
     create_serverless_tutorial_archive(output_dir)